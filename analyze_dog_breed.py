@@ -1,6 +1,7 @@
 from openai import OpenAI
 import os
 from dotenv import load_dotenv
+from breed_cache import analysis_cache_key, get_cached_analysis, cache_analysis
 import base64
 
 # Load environment variables
@@ -9,6 +10,10 @@ load_dotenv()
 # Initialize OpenAI client
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
+# Model and prompt for the breed analysis call (both are part of the analysis cache key)
+BREED_ANALYSIS_MODEL = "gpt-5-mini-2025-08-07"
+BREED_ANALYSIS_PROMPT = "Analyze this human face and determine which specific dog breed this person's facial features, structure, and overall appearance most closely resembles. Consider factors like face shape, eye shape, nose structure, ear position, and overall facial proportions. Respond with just the dog breed name and a brief one-sentence explanation of why."
+
 def analyze_dog_breed(image_path):
     """
     Analyze an image to determine which dog breed the person most closely resembles.
@@ -19,15 +24,21 @@ def analyze_dog_breed(image_path):
             image_data = image_file.read()
             base64_image = base64.b64encode(image_data).decode('utf-8')
         
+        # Skip the API call if this exact image has been analyzed recently
+        cache_key = analysis_cache_key(image_data, BREED_ANALYSIS_MODEL, BREED_ANALYSIS_PROMPT)
+        cached_description = get_cached_analysis(cache_key)
+        if cached_description is not None:
+            return cached_description
+        
         # Use Responses API to analyze the image
         response = client.responses.create(
-            model="gpt-5-mini-2025-08-07",
+            model=BREED_ANALYSIS_MODEL,
             input=[{
                 "role": "user",
                 "content": [
                     {
                         "type": "input_text",
-                        "text": "Analyze this human face and determine which specific dog breed this person's facial features, structure, and overall appearance most closely resembles. Consider factors like face shape, eye shape, nose structure, ear position, and overall facial proportions. Respond with just the dog breed name and a brief one-sentence explanation of why."
+                        "text": BREED_ANALYSIS_PROMPT
                     },
                     {
                         "type": "input_image",
@@ -37,6 +48,7 @@ def analyze_dog_breed(image_path):
             }],
         )
         
+        cache_analysis(cache_key, response.output_text)
         return response.output_text
     except Exception as e:
         return f"Error: {str(e)}"
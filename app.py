@@ -1,13 +1,19 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory, jsonify
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import functools
 import os
-import traceback
-from datetime import datetime
+import secrets
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
-from generate_transformation import analyze_dog_breed, extract_dog_breed, generate_progressive_images
+from generate_transformation import MAX_PIPELINE_SECONDS, analyze_dog_breed, create_thumbnail, encode_image, extract_dog_breed, generate_progressive_images, prepare_image
 
 load_dotenv()
 
@@ -18,6 +24,14 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['GENERATED_IMAGES_FOLDER'] = 'static/generated_images'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['IMAGES_PER_PAGE'] = 24
+# Background job limits; under gunicorn these apply per worker process (see gunicorn.conf.py)
+app.config['PIPELINE_WORKERS'] = int(os.getenv('PIPELINE_WORKERS', 4))
+app.config['MAX_PENDING_JOBS'] = int(os.getenv('MAX_PENDING_JOBS', 16))  # queued + running, each holds its upload in memory
+# Seconds a started job may run before it is treated as lost: the worst-case API time plus margin
+app.config['JOB_TIMEOUT'] = int(MAX_PIPELINE_SECONDS) + 5 * 60
+# Seconds a job may wait in the queue before starting: enough for every job ahead of it to time out
+app.config['QUEUE_TIMEOUT'] = app.config['JOB_TIMEOUT'] * -(-app.config['MAX_PENDING_JOBS'] // app.config['PIPELINE_WORKERS'])
 
 # Initialize extensions
 db = SQLAlchemy(app)
@@ -26,39 +40,194 @@ login_manager.init_app(app)
 login_manager.login_view = 'login'
 login_manager.login_message = 'Please log in to access this page.'
 
+# Background workers for the (slow) breed analysis and image generation pipeline
+executor = ThreadPoolExecutor(max_workers=app.config['PIPELINE_WORKERS'])
+job_slots = threading.BoundedSemaphore(app.config['MAX_PENDING_JOBS'])
+
 # Create directories
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['GENERATED_IMAGES_FOLDER'], exist_ok=True)
 os.makedirs('static', exist_ok=True)
 
+@functools.lru_cache(maxsize=4096)
+def ensure_user_upload_dir(user_id):
+    """
+    Create a user's upload folder once per process and return it. The result is cached, so if
+    the folder is removed while the app is running, that process's uploads fail until restart.
+    (Generated images need no setup here; each job creates its own output folder.)
+    """
+    user_upload_dir = os.path.join(app.config['UPLOAD_FOLDER'], str(user_id))
+    os.makedirs(user_upload_dir, exist_ok=True)
+    return user_upload_dir
+
+def utcnow():
+    return datetime.now(timezone.utc)
+
 # Database Models
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False, index=True)
     password_hash = db.Column(db.String(255), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=utcnow)
     
-    # Relationship to images
-    images = db.relationship('GeneratedImage', backref='user', lazy=True, cascade='all, delete-orphan')
+    # Relationship to images (a query, so callers filter and limit in SQL instead of loading every row)
+    images = db.relationship('GeneratedImage', backref='user', lazy='dynamic', cascade='all, delete-orphan')
 
 class GeneratedImage(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     original_filename = db.Column(db.String(255), nullable=False)
     original_image_path = db.Column(db.String(255), nullable=True)
-    dog_breed = db.Column(db.String(100), nullable=False)
-    image1_path = db.Column(db.String(255), nullable=False)
-    image2_path = db.Column(db.String(255), nullable=False)
-    image3_path = db.Column(db.String(255), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Filled in by the background pipeline once generation finishes
+    dog_breed = db.Column(db.String(100), nullable=True)
+    image1_path = db.Column(db.String(255), nullable=True)
+    image2_path = db.Column(db.String(255), nullable=True)
+    image3_path = db.Column(db.String(255), nullable=True)
+    original_thumb = db.Column(db.String(255), nullable=True)
+    image1_thumb = db.Column(db.String(255), nullable=True)
+    image2_thumb = db.Column(db.String(255), nullable=True)
+    image3_thumb = db.Column(db.String(255), nullable=True)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, done, error
+    error_message = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)  # when a background worker picked the job up
+    
+    # Serves the dashboard query (a user's images, newest first)
+    __table_args__ = (db.Index('ix_generated_image_user_created', 'user_id', 'created_at'),)
 
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
 
+# Use WAL so dashboard reads don't block on (or block) background jobs writing their results
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
+LOST_JOB_MESSAGE = 'Generation was interrupted. Please try again.'
+
+def stale_job_cutoffs():
+    """
+    Return (run_cutoff, queue_cutoff) as naive UTC, matching stored timestamps. Pending jobs
+    started before run_cutoff, or never started and created before queue_cutoff, are lost.
+    """
+    now = utcnow().replace(tzinfo=None)
+    return (now - timedelta(seconds=app.config['JOB_TIMEOUT']),
+            now - timedelta(seconds=app.config['QUEUE_TIMEOUT']))
+
+def expire_stale_jobs():
+    """Mark lost pending jobs as failed (their worker was restarted or killed)"""
+    run_cutoff, queue_cutoff = stale_job_cutoffs()
+    GeneratedImage.query.filter(
+        GeneratedImage.status == 'pending',
+        db.or_(
+            db.and_(GeneratedImage.started_at.isnot(None), GeneratedImage.started_at < run_cutoff),
+            db.and_(GeneratedImage.started_at.is_(None), GeneratedImage.created_at < queue_cutoff)
+        )
+    ).update({'status': 'error', 'error_message': LOST_JOB_MESSAGE}, synchronize_session=False)
+    db.session.commit()
+
+def job_state(generated_image):
+    """Return (status, error_message) for a job, reporting lost jobs as errors without writing to the database"""
+    if generated_image.status == 'pending':
+        run_cutoff, queue_cutoff = stale_job_cutoffs()
+        if generated_image.started_at is not None:
+            lost = generated_image.started_at < run_cutoff
+        else:
+            lost = generated_image.created_at < queue_cutoff
+        if lost:
+            return 'error', LOST_JOB_MESSAGE
+    return generated_image.status, generated_image.error_message
+
 # Create database tables
 with app.app_context():
     db.create_all()
+    expire_stale_jobs()
+
+# Leading bytes of the accepted image formats (WEBP is checked separately)
+IMAGE_SIGNATURES = (b'\x89PNG\r\n\x1a\n', b'\xff\xd8\xff', b'GIF87a', b'GIF89a')
+
+def is_image_header(header):
+    """Check whether the first 12 bytes of a file match a supported image format"""
+    if header.startswith(IMAGE_SIGNATURES):
+        return True
+    return header[:4] == b'RIFF' and header[8:12] == b'WEBP'
+
+def create_thumbnail_or_none(image_path):
+    """Best-effort thumbnail; the dashboard falls back to the full image when this returns None"""
+    try:
+        return create_thumbnail(image_path)
+    except Exception:
+        app.logger.exception("Error creating thumbnail for %s", image_path)
+        return None
+
+def update_job(image_id, **values):
+    """
+    Update a pending job's GeneratedImage row in a single UPDATE. Rows no longer pending
+    (e.g. already expired as lost) are left alone. Returns whether the row was updated.
+    """
+    updated = GeneratedImage.query.filter_by(id=image_id, status='pending').update(values)
+    db.session.commit()
+    return updated > 0
+
+def run_pipeline(image_id, image_data, user_id, original_image_path):
+    """
+    Analyze the uploaded image and generate the transformation images in the background,
+    recording the result on the pending GeneratedImage row.
+    """
+    with app.app_context():
+        try:
+            # Timeouts count from here, not from when the job was queued
+            if not update_job(image_id, started_at=utcnow()):
+                return  # expired while queued
+            
+            # Send a downscaled JPEG to the API; the original upload stays on disk
+            image_data = prepare_image(image_data)
+            
+            # Encode once and share it between the analysis and generation calls
+            base64_image = encode_image(image_data)
+            
+            # Analyze breed and generate images
+            breed_description = analyze_dog_breed(image_data, base64_image=base64_image)
+            dog_breed = extract_dog_breed(breed_description)
+            
+            # Each generation gets its own folder so later runs don't overwrite earlier images
+            output_dir = os.path.join(app.config['GENERATED_IMAGES_FOLDER'], str(user_id), str(image_id))
+            images = generate_progressive_images(image_data, dog_breed, output_dir=output_dir, base64_image=base64_image)
+            
+            # Small thumbnails for the dashboard; the full images are linked from them
+            thumbs = [create_thumbnail_or_none(path) for path in images]
+            original_thumb = create_thumbnail_or_none(original_image_path)
+            
+            update_job(
+                image_id,
+                dog_breed=dog_breed,
+                image1_path=images[0],
+                image2_path=images[1],
+                image3_path=images[2],
+                original_thumb=original_thumb,
+                image1_thumb=thumbs[0],
+                image2_thumb=thumbs[1],
+                image3_thumb=thumbs[2],
+                status='done'
+            )
+            
+        except Exception as e:
+            db.session.rollback()
+            error_msg = str(e)
+            app.logger.exception("Error generating images: %s", error_msg)
+            try:
+                update_job(image_id, status='error', error_message=error_msg)
+            except Exception:
+                # Nobody reads this future's result, so log here; the row expires as lost later
+                db.session.rollback()
+                app.logger.exception("Error recording failure for job %s", image_id)
+        finally:
+            db.session.remove()
 
 # Routes
 @app.route('/')
@@ -138,9 +307,14 @@ def logout():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    # Only get images for the current user, ordered by most recent first
-    images = GeneratedImage.query.filter_by(user_id=current_user.id).order_by(GeneratedImage.created_at.desc()).all()
-    return render_template('dashboard.html', images=images)
+    # Only get images for the current user, ordered by most recent first, one page at a time
+    page = request.args.get('page', 1, type=int)
+    pagination = current_user.images.filter_by(status='done') \
+        .order_by(GeneratedImage.created_at.desc()) \
+        .paginate(page=page, per_page=app.config['IMAGES_PER_PAGE'], error_out=False)
+    if pagination.pages and page > pagination.pages:
+        return redirect(url_for('dashboard', page=pagination.pages))
+    return render_template('dashboard.html', images=pagination.items, pagination=pagination)
 
 @app.route('/generate', methods=['GET', 'POST'])
 @login_required
@@ -160,56 +334,88 @@ def generate():
             flash('Invalid file type. Please upload an image file (PNG, JPG, JPEG, GIF, or WEBP).', 'error')
             return redirect(request.url)
         
+        # Check the content too, before anything is written to disk
+        header = file.stream.read(12)
+        file.stream.seek(0)
+        if not is_image_header(header):
+            flash('Invalid file contents. Please upload a valid image file (PNG, JPG, JPEG, GIF, or WEBP).', 'error')
+            return redirect(request.url)
+        
+        # Each queued job holds its upload in memory, so bound how many can be outstanding
+        if not job_slots.acquire(blocking=False):
+            flash('Too many images are being generated right now. Please try again in a few minutes.', 'error')
+            return redirect(request.url)
+        
         try:
             # Save uploaded file
             filename = secure_filename(file.filename)
-            user_upload_dir = os.path.join(app.config['UPLOAD_FOLDER'], str(current_user.id))
-            os.makedirs(user_upload_dir, exist_ok=True)
+            user_upload_dir = ensure_user_upload_dir(current_user.id)
             
-            # Add timestamp to filename to avoid conflicts
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            filename = f"{timestamp}_{filename}"
+            # Add a random prefix to filename to avoid conflicts (even for double submits)
+            filename = f"{secrets.token_hex(6)}_{filename}"
             filepath = os.path.join(user_upload_dir, filename)
-            file.save(filepath)
-            
-            # Analyze breed and generate images
-            breed_description = analyze_dog_breed(filepath)
-            dog_breed = extract_dog_breed(breed_description)
             
-            # Generate images and save to user-specific folder
-            user_images_dir = os.path.join(app.config['GENERATED_IMAGES_FOLDER'], str(current_user.id))
-            os.makedirs(user_images_dir, exist_ok=True)
+            # Keep the upload in memory for the pipeline and write it to disk once for display
+            image_data = file.read()
+            with open(filepath, 'wb') as f:
+                f.write(image_data)
             
-            # Generate images (this may take a while)
-            images = generate_progressive_images(filepath, dog_breed, output_dir=user_images_dir)
-            
-            # Save to database
+            # Record the job, then hand the slow analysis/generation off to a background worker
             generated_image = GeneratedImage(
                 user_id=current_user.id,
                 original_filename=file.filename,
                 original_image_path=filepath,
-                dog_breed=dog_breed,
-                image1_path=images[0][0],
-                image2_path=images[1][0],
-                image3_path=images[2][0]
+                status='pending'
             )
             db.session.add(generated_image)
             db.session.commit()
             
-            flash(f'Images generated successfully! Detected breed: {dog_breed}', 'success')
-            return redirect(url_for('dashboard'))
+            future = executor.submit(run_pipeline, generated_image.id, image_data, current_user.id, filepath)
+            future.add_done_callback(lambda _: job_slots.release())
+            
+            return redirect(url_for('job', image_id=generated_image.id))
             
         except Exception as e:
+            job_slots.release()
             db.session.rollback()
             error_msg = str(e)
-            error_trace = traceback.format_exc()
-            print(f"Error generating images: {error_msg}")
-            print(f"Traceback: {error_trace}")
+            app.logger.exception("Error generating images: %s", error_msg)
             flash(f'Error generating images: {error_msg}', 'error')
             return redirect(request.url)
     
     return render_template('generate.html')
 
+@app.route('/job/<int:image_id>')
+@login_required
+def job(image_id):
+    """Show progress for a background generation job"""
+    generated_image = GeneratedImage.query.filter_by(id=image_id, user_id=current_user.id).first()
+    if generated_image is None:
+        flash('Job not found', 'error')
+        return redirect(url_for('dashboard'))
+    
+    status, error_message = job_state(generated_image)
+    if status == 'done':
+        flash(f'Images generated successfully! Detected breed: {generated_image.dog_breed}', 'success')
+        return redirect(url_for('dashboard'))
+    
+    return render_template('job.html', job=generated_image, status=status, error_message=error_message,
+                           job_timeout=app.config['QUEUE_TIMEOUT'] + app.config['JOB_TIMEOUT'])
+
+@app.route('/job/<int:image_id>/status')
+@login_required
+def job_status(image_id):
+    """Report the status of a background generation job as JSON"""
+    generated_image = GeneratedImage.query.filter_by(id=image_id, user_id=current_user.id).first()
+    if generated_image is None:
+        return jsonify({'error': 'Job not found'}), 404
+    status, error_message = job_state(generated_image)
+    return jsonify({
+        'status': status,
+        'dog_breed': generated_image.dog_breed,
+        'error': error_message
+    })
+
 @app.route('/images/<path:filename>')
 @login_required
 def serve_image(filename):
@@ -225,7 +431,9 @@ def serve_image(filename):
         
         directory = os.path.join(app.config['GENERATED_IMAGES_FOLDER'], parts[0])
         filepath = '/'.join(parts[1:])
-        return send_from_directory(directory, filepath)
+        response = send_from_directory(directory, filepath, conditional=True, max_age=86400)
+        response.headers['Cache-Control'] = 'private, max-age=86400'
+        return response
     
     flash('Invalid image path', 'error')
     return redirect(url_for('dashboard'))
@@ -245,11 +453,14 @@ def serve_upload(filename):
         
         directory = os.path.join(app.config['UPLOAD_FOLDER'], parts[0])
         filepath = '/'.join(parts[1:])
-        return send_from_directory(directory, filepath)
+        response = send_from_directory(directory, filepath, conditional=True, max_age=86400)
+        response.headers['Cache-Control'] = 'private, max-age=86400'
+        return response
     
     flash('Invalid image path', 'error')
     return redirect(url_for('dashboard'))
 
 if __name__ == '__main__':
+    # Development server only; production runs under gunicorn (see Procfile)
     app.run(debug=True, host='0.0.0.0', port=5001)
 
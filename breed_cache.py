@@ -0,0 +1,76 @@
+"""
+Persistent cache of dog breed analyses, keyed by a SHA-256 hash of the image bytes together
+with the model and prompt used. Re-uploading the same photo skips the OpenAI analysis call
+entirely, while changing the model or prompt starts a fresh keyspace.
+
+The cache is best-effort: if the database can't be read or written (locked, read-only
+filesystem, ...) the error is logged and callers behave as on a cache miss.
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+logger = logging.getLogger(__name__)
+
+CACHE_PATH = os.getenv("BREED_CACHE_PATH", ".cache/breed_cache.db")
+CACHE_TTL = 30 * 24 * 60 * 60  # 30 days, in seconds
+
+def analysis_cache_key(image_data, model, prompt):
+    """
+    Return the cache key for analyzing the raw image bytes with the given model and prompt.
+    """
+    digest = hashlib.sha256()
+    for part in (model.encode('utf-8'), prompt.encode('utf-8'), image_data):
+        # Length-prefix each part so different splits can't collide
+        digest.update(len(part).to_bytes(8, 'big'))
+        digest.update(part)
+    return digest.hexdigest()
+
+def _init_cache():
+    try:
+        os.makedirs(os.path.dirname(CACHE_PATH) or ".", exist_ok=True)
+        with closing(sqlite3.connect(CACHE_PATH)) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS breed_cache ("
+                "hash TEXT PRIMARY KEY, description TEXT NOT NULL, ts REAL NOT NULL)"
+            )
+            # Supports pruning expired entries on write
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_breed_cache_ts ON breed_cache (ts)")
+    except (OSError, sqlite3.Error):
+        logger.exception("Breed cache unavailable at %s", CACHE_PATH)
+
+_init_cache()
+
+def get_cached_analysis(key):
+    """
+    Return the cached breed description for a cache key, or None if missing, expired
+    or the cache can't be read.
+    """
+    try:
+        with closing(sqlite3.connect(CACHE_PATH)) as conn:
+            row = conn.execute("SELECT description, ts FROM breed_cache WHERE hash = ?", (key,)).fetchone()
+    except sqlite3.Error:
+        logger.exception("Error reading breed cache")
+        return None
+    if row is None or time.time() - row[1] > CACHE_TTL:
+        return None
+    return row[0]
+
+def cache_analysis(key, description):
+    """
+    Store the breed description for a cache key, logging (not raising) on failure.
+    Expired entries are pruned at the same time so the table doesn't grow without bound.
+    """
+    now = time.time()
+    try:
+        with closing(sqlite3.connect(CACHE_PATH)) as conn, conn:
+            conn.execute("DELETE FROM breed_cache WHERE ts < ?", (now - CACHE_TTL,))
+            conn.execute(
+                "INSERT OR REPLACE INTO breed_cache (hash, description, ts) VALUES (?, ?, ?)",
+                (key, description, now),
+            )
+    except sqlite3.Error:
+        logger.exception("Error writing breed cache")
@@ -1,43 +1,158 @@
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 import os
 from dotenv import load_dotenv
+from breed_cache import analysis_cache_key, get_cached_analysis, cache_analysis
+from PIL import Image, ImageOps
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import base64
+import httpx
+import io
+import json
+import logging
 import re
 
 # Load environment variables
 load_dotenv()
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+logger = logging.getLogger(__name__)
 
-def analyze_dog_breed(image_path):
+# Keep connections to the API warm (and multiplexed over HTTP/2) between calls
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=20, max_connections=50, keepalive_expiry=60.0)
+
+# Per-request API timeout (seconds) and attempts per call; together they bound how long a job can run
+API_TIMEOUT = 180.0
+MAX_ATTEMPTS = 3
+MAX_BACKOFF = 30
+
+# Worst case for the analysis call followed by the (concurrent) generation calls
+MAX_PIPELINE_SECONDS = 2 * (MAX_ATTEMPTS * API_TIMEOUT + (MAX_ATTEMPTS - 1) * MAX_BACKOFF)
+
+# Initialize OpenAI client (retries are handled by retry_transient below)
+client = OpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    http_client=DefaultHttpxClient(http2=True, limits=HTTP_LIMITS),
+    max_retries=0,
+    timeout=API_TIMEOUT,
+)
+
+# Retry transient API failures (rate limits, timeouts, dropped connections, 5xx) with exponential backoff
+retry_transient = retry(
+    retry=retry_if_exception_type((RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)),
+    wait=wait_exponential(min=1, max=MAX_BACKOFF),
+    stop=stop_after_attempt(MAX_ATTEMPTS),
+    reraise=True,
+)
+
+@retry_transient
+def _create_response(**kwargs):
+    return client.responses.create(**kwargs)
+
+# Maximum number of image-generation requests in flight at once
+MAX_CONCURRENT_GENERATIONS = 3
+
+# Matches a JSON "breed" field embedded in non-JSON text
+_BREED_RE = re.compile(r'\{[^{}]*"breed"\s*:\s*"([^"]+)"', re.S)
+
+# Model and prompt for the breed analysis call (both are part of the analysis cache key)
+BREED_ANALYSIS_MODEL = "gpt-5-mini-2025-08-07"
+BREED_ANALYSIS_PROMPT = "Analyze this human face and determine which specific dog breed this person's facial features, structure, and overall appearance most closely resembles. Consider factors like face shape, eye shape, nose structure, ear position, and overall facial proportions. Respond with JSON in the form {\"breed\": \"<dog breed name>\", \"why\": \"<brief one-sentence explanation>\"}."
+
+# Output filename and prompt template for each stage of the transformation
+TRANSFORMATION_PROMPTS = [
+    # Image 1: Slight transformation - subtle dog-like features
+    ("image1_transition.png", "Transform this person's face to have very subtle {dog_breed} dog-like features - slightly more pronounced nose, subtle changes around the eyes and mouth, but maintain the human appearance overall. Keep the same pose, expression, and lighting."),
+    # Image 2: Medium transformation - halfway between human and dog
+    ("image2_transition.png", "Transform this person's face to be halfway between human and {dog_breed} dog - blend human and canine features more prominently. The face should show clear dog characteristics while maintaining some human-like structure. Keep the same pose and composition."),
+    # Image 3: Final transformation - full dog form
+    ("image3_final_dog.png", "Transform this person into a realistic {dog_breed} dog portrait that maintains the same pose, expression, and composition as the original person. The dog should have the same general facial structure and expression, but as a fully formed {dog_breed} dog. However, the dog should still be wearing the same clothing as the human."),
+]
+
+# Longest edge (in pixels) of the image sent to the API
+MAX_IMAGE_EDGE = 1024
+
+def prepare_image(image_data, max_edge=MAX_IMAGE_EDGE):
+    """
+    Downscale an image to fit within max_edge pixels and re-encode it as JPEG.
+    Keeps API uploads small regardless of the original photo size.
+    """
+    with Image.open(io.BytesIO(image_data)) as img:
+        # Re-encoding drops EXIF, so apply the camera orientation first
+        img = ImageOps.exif_transpose(img).convert('RGB')
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        buffer = io.BytesIO()
+        img.save(buffer, 'JPEG', quality=85, optimize=True)
+    return buffer.getvalue()
+
+# Longest edge (in pixels) of the dashboard thumbnails
+THUMBNAIL_EDGE = 256
+
+def create_thumbnail(image_path, max_edge=THUMBNAIL_EDGE):
+    """
+    Save a small WEBP thumbnail next to an image and return its path.
+    """
+    thumb_path = f"{os.path.splitext(image_path)[0]}_thumb.webp"
+    with Image.open(image_path) as img:
+        # Uploaded photos may carry an EXIF rotation or use modes WEBP can't store
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB')
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        img.save(thumb_path, 'WEBP', quality=75)
+    return thumb_path
+
+def encode_image(image_data):
+    """
+    Base64-encode raw image bytes for use in an image data URL.
+    """
+    return base64.b64encode(image_data).decode('utf-8')
+
+def image_data_url(base64_image):
+    """
+    Build the data URL used to send a base64-encoded JPEG to the API.
+    """
+    return f"data:image/jpeg;base64,{base64_image}"
+
+def analyze_dog_breed(image_data, base64_image=None):
     """
     Analyze an image to determine which dog breed the person most closely resembles.
+    
+    Args:
+        image_data: Raw bytes of the input image
+        base64_image: Optional pre-computed base64 encoding of image_data
     """
     try:
-        # Read and encode the image
-        with open(image_path, "rb") as image_file:
-            image_data = image_file.read()
-            base64_image = base64.b64encode(image_data).decode('utf-8')
+        # Skip the API call if this exact image has been analyzed recently
+        cache_key = analysis_cache_key(image_data, BREED_ANALYSIS_MODEL, BREED_ANALYSIS_PROMPT)
+        cached_description = get_cached_analysis(cache_key)
+        if cached_description is not None:
+            return cached_description
+        
+        if base64_image is None:
+            base64_image = encode_image(image_data)
         
         # Use Responses API to analyze the image
-        response = client.responses.create(
-            model="gpt-5-mini-2025-08-07",
+        response = _create_response(
+            model=BREED_ANALYSIS_MODEL,
             input=[{
                 "role": "user",
                 "content": [
                     {
                         "type": "input_text",
-                        "text": "Analyze this human face and determine which specific dog breed this person's facial features, structure, and overall appearance most closely resembles. Consider factors like face shape, eye shape, nose structure, ear position, and overall facial proportions. Respond with just the dog breed name and a brief one-sentence explanation of why."
+                        "text": BREED_ANALYSIS_PROMPT
                     },
                     {
                         "type": "input_image",
-                        "image_url": f"data:image/jpeg;base64,{base64_image}",
+                        "image_url": image_data_url(base64_image),
                     },
                 ],
             }],
+            text={"format": {"type": "json_object"}},
         )
         
+        cache_analysis(cache_key, response.output_text)
         return response.output_text
     except Exception as e:
         raise Exception(f"Error analyzing dog breed: {str(e)}")
@@ -46,6 +161,22 @@ def extract_dog_breed(breed_description):
     """
     Extract the dog breed name from the analysis text.
     """
+    try:
+        analysis = json.loads(breed_description)
+    except ValueError:
+        analysis = None
+    
+    if analysis is not None:
+        breed = analysis.get("breed") if isinstance(analysis, dict) else None
+        if isinstance(breed, str) and breed.strip():
+            return breed.strip()
+        return "dog"
+    
+    # Fall back to free-form text (e.g. analyses cached before the JSON prompt)
+    match = _BREED_RE.search(breed_description)
+    if match:
+        return match.group(1).strip()
+    
     # Try to extract the breed name (usually the first few words before a period or comma)
     # Common pattern: "Labrador Retriever" or "Golden Retriever" etc.
     # Take first 2-3 words as breed name
@@ -56,149 +187,104 @@ def extract_dog_breed(breed_description):
             return f"{words[0]} {words[1]}"
     return words[0] if words else "dog"
 
-def generate_progressive_images(image_path, dog_breed, output_dir=None):
+def _extract_image(response, image_number):
+    """
+    Return the base64 result of the first image generation call in a response.
+    """
+    for output in response.output:
+        if getattr(output, 'type', None) == "image_generation_call" and getattr(output, 'result', None):
+            return output.result
+    raise Exception(f"Failed to generate image {image_number}")
+
+def _save_image(filepath, image_base64):
+    with open(filepath, "wb") as f:
+        f.write(base64.b64decode(image_base64))
+
+async def _generate_all(prompts, data_url):
+    """
+    Run one image-generation request per prompt concurrently against the same source image.
+    
+    The Responses API image_generation tool produces one image per call (it has no `n`
+    option), so the stages are separate requests; running them concurrently keeps the
+    wall-clock cost at roughly one round trip.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_GENERATIONS)
+
+    # The async client is bound to this event loop, so it lives for one run; over HTTP/2
+    # the concurrent requests share a single connection instead of each opening their own
+    async with AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        http_client=DefaultAsyncHttpxClient(http2=True, limits=HTTP_LIMITS),
+        max_retries=0,
+        timeout=API_TIMEOUT,
+    ) as async_client:
+        # Retried per prompt, so one flaky call doesn't discard the others
+        @retry_transient
+        async def _gen(prompt):
+            async with semaphore:
+                return await async_client.responses.create(
+                    model="gpt-5",
+                    input=[{
+                        "role": "user",
+                        "content": [
+                            {"type": "input_text", "text": prompt},
+                            {"type": "input_image", "image_url": data_url},
+                        ],
+                    }],
+                    tools=[{"type": "image_generation", "action": "auto", "input_fidelity": "high"}],
+                )
+
+        return await asyncio.gather(*(_gen(prompt) for prompt in prompts))
+
+def generate_progressive_images(image_data, dog_breed, output_dir=None, base64_image=None):
     """
     Generate 3 progressive images transforming from human to dog.
-    Each image gets closer to the final dog form.
+    Each image gets closer to the final dog form. The three images are generated
+    concurrently from the original photo rather than chained one after another.
     
     Args:
-        image_path: Path to the input image
+        image_data: Raw bytes of the input image
         dog_breed: Dog breed name
         output_dir: Optional directory to save images (defaults to current directory)
+        base64_image: Optional pre-computed base64 encoding of image_data
     
     Returns:
-        List of tuples: [(filename1, base64_data1), (filename2, base64_data2), (filename3, base64_data3)]
+        List of saved image paths: [filepath1, filepath2, filepath3]
     """
-    # Read and encode the original image
-    with open(image_path, "rb") as image_file:
-        image_data = image_file.read()
-        base64_image = base64.b64encode(image_data).decode('utf-8')
-    
-    generated_images = []
-    
-    # Image 1: Slight transformation - subtle dog-like features
-    print("\nGenerating image 1/3: Subtle transformation...")
-    prompt1 = f"Transform this person's face to have very subtle {dog_breed} dog-like features - slightly more pronounced nose, subtle changes around the eyes and mouth, but maintain the human appearance overall. Keep the same pose, expression, and lighting."
-    
-    try:
-        response1 = client.responses.create(
-            model="gpt-5",
-            input=[{
-                "role": "user",
-                "content": [
-                    {"type": "input_text", "text": prompt1},
-                    {
-                        "type": "input_image",
-                        "image_url": f"data:image/jpeg;base64,{base64_image}",
-                    },
-                ],
-            }],
-            tools=[{"type": "image_generation", "action": "auto", "input_fidelity": "high"}],
-        )
-    except Exception as e:
-        print(f"Error in API call for image 1: {str(e)}")
-        raise
-    
-    # Extract image 1
-    image1_data = [
-        output.result
-        for output in response1.output
-        if hasattr(output, 'type') and output.type == "image_generation_call" and hasattr(output, 'result')
-    ]
+    if base64_image is None:
+        base64_image = encode_image(image_data)
+    data_url = image_data_url(base64_image)
     
-    if not image1_data:
-        raise Exception("Failed to generate image 1")
+    filenames = [filename for filename, _ in TRANSFORMATION_PROMPTS]
+    prompts = [template.format(dog_breed=dog_breed) for _, template in TRANSFORMATION_PROMPTS]
     
-    image1_base64 = image1_data[0]
-    generated_images.append(("image1_transition.png", image1_base64))
-    print("✓ Image 1 generated")
+    logger.info("Generating %d images concurrently...", len(prompts))
+    responses = asyncio.run(_generate_all(prompts, data_url))
     
-    # Image 2: Medium transformation - halfway between human and dog
-    print("Generating image 2/3: Medium transformation...")
-    prompt2 = f"Transform this image to be halfway between human and {dog_breed} dog - blend human and canine features more prominently. The face should show clear dog characteristics while maintaining some human-like structure. Keep the same pose and composition."
-    
-    response2 = client.responses.create(
-        model="gpt-5",
-        previous_response_id=response1.id,
-        input=prompt2,
-        tools=[{"type": "image_generation", "action": "edit", "input_fidelity": "high"}],
-    )
-    
-    # Extract image 2
-    image2_data = [
-        output.result
-        for output in response2.output
-        if hasattr(output, 'type') and output.type == "image_generation_call" and hasattr(output, 'result')
-    ]
-    
-    if not image2_data:
-        raise Exception("Failed to generate image 2")
-    
-    image2_base64 = image2_data[0]
-    generated_images.append(("image2_transition.png", image2_base64))
-    print("✓ Image 2 generated")
-    
-    # Image 3: Final transformation - full dog form
-    print("Generating image 3/3: Final dog transformation...")
-    prompt3 = f"Transform this into a realistic {dog_breed} dog portrait that maintains the same pose, expression, and composition as the original person. The dog should have the same general facial structure and expression, but as a fully formed {dog_breed} dog. However, the dog should still be wearing the same clothing as the human."
-    
-    try:
-        response3 = client.responses.create(
-            model="gpt-5",
-            previous_response_id=response2.id,
-            input=prompt3,
-            tools=[{"type": "image_generation", "action": "edit", "input_fidelity": "high"}],
-        )
-    except Exception as e:
-        print(f"[DEBUG] Error in API call for image 3: {str(e)}")
-        raise
-    
-    # Debug: Check response structure
-    if hasattr(response3, 'output'):
-        print(f"[DEBUG] Response3.output length: {len(response3.output) if hasattr(response3.output, '__len__') else 'N/A'}")
-        for i, output in enumerate(response3.output):
-            if hasattr(output, 'type'):
-                print(f"[DEBUG] Output {i} type: {output.type}")
-                if output.type == "image_generation_call" and hasattr(output, 'result'):
-                    print(f"[DEBUG] Output {i} has result: {bool(output.result)}")
-    
-    # Extract image 3
-    image3_data = [
-        output.result
-        for output in response3.output
-        if hasattr(output, 'type') and output.type == "image_generation_call" and hasattr(output, 'result')
-    ]
-    
-    if not image3_data:
-        print(f"[DEBUG] No image_generation_call found for image 3. Available outputs:")
-        for output in response3.output:
-            print(f"  - {output}")
-        raise Exception("Failed to generate image 3")
-    
-    image3_base64 = image3_data[0]
-    generated_images.append(("image3_final_dog.png", image3_base64))
-    print("✓ Image 3 generated")
+    generated_images = []
+    for i, (filename, response) in enumerate(zip(filenames, responses), start=1):
+        generated_images.append((filename, _extract_image(response, i)))
+        logger.info("Image %d generated", i)
     
     # Save all images
     if output_dir:
-        import os
         os.makedirs(output_dir, exist_ok=True)
-        print(f"\nSaving images to {output_dir}...")
-        saved_paths = []
-        for filename, image_base64 in generated_images:
-            filepath = os.path.join(output_dir, filename)
-            with open(filepath, "wb") as f:
-                f.write(base64.b64decode(image_base64))
-            saved_paths.append((filepath, image_base64))
-            print(f"  Saved: {filepath}")
-        return saved_paths
+        saved_images = [
+            (os.path.join(output_dir, filename), image_base64)
+            for filename, image_base64 in generated_images
+        ]
     else:
-        print("\nSaving images...")
-        for filename, image_base64 in generated_images:
-            with open(filename, "wb") as f:
-                f.write(base64.b64decode(image_base64))
-            print(f"  Saved: {filename}")
-        return generated_images
+        saved_images = generated_images
+    
+    # Decode and write the images in parallel
+    with ThreadPoolExecutor(max_workers=len(saved_images)) as executor:
+        list(executor.map(lambda image: _save_image(*image), saved_images))
+    
+    # Return just the paths so the base64 data can be freed
+    saved_paths = [filepath for filepath, _ in saved_images]
+    for filepath in saved_paths:
+        logger.info("Saved: %s", filepath)
+    return saved_paths
 
 def main(image_path):
     """
@@ -208,9 +294,14 @@ def main(image_path):
     print("Shaggy Dog Transformation Generator")
     print("="*60)
     
+    # Read and encode the image once for both steps
+    with open(image_path, "rb") as image_file:
+        image_data = prepare_image(image_file.read())
+    base64_image = encode_image(image_data)
+    
     # Step 1: Analyze dog breed
     print(f"\nStep 1: Analyzing {image_path}...")
-    breed_description = analyze_dog_breed(image_path)
+    breed_description = analyze_dog_breed(image_data, base64_image=base64_image)
     print("\nDog Breed Analysis:")
     print("-" * 60)
     print(breed_description)
@@ -225,11 +316,11 @@ def main(image_path):
     print("="*60)
     
     try:
-        images = generate_progressive_images(image_path, dog_breed)
+        images = generate_progressive_images(image_data, dog_breed, base64_image=base64_image)
         print("\n" + "="*60)
         print("SUCCESS! All images generated successfully!")
         print(f"Generated {len(images)} images:")
-        for filename, _ in images:
+        for filename in images:
             print(f"  - {filename}")
         print("="*60)
         return images
@@ -238,6 +329,7 @@ def main(image_path):
         raise
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     image_path = "Obama.jpeg"
     main(image_path)
 
@@ -0,0 +1,17 @@
+# Gunicorn settings for production (see Procfile)
+#
+# The app is imported once in the master process (preload_app) so the database schema is
+# created before any worker starts. Each worker then runs its own background job executor:
+# PIPELINE_WORKERS and MAX_PENDING_JOBS apply per gunicorn worker, not per deployment.
+
+worker_class = 'gthread'
+workers = 4
+threads = 16
+timeout = 120
+preload_app = True
+
+def post_fork(server, worker):
+    # Don't share the master's pooled database connections with the forked worker
+    from app import app, db
+    with app.app_context():
+        db.engine.dispose(close=False)
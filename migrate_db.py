@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 """
-Simple migration script to add original_image_path column to existing database.
-Run this once to update your database schema.
+Simple migration script to bring an existing database up to the current schema.
+Run this after pulling schema changes; steps that are already applied are skipped.
 """
 import sqlite3
 import os
@@ -15,25 +15,83 @@ if not os.path.exists(db_path):
     print(f"Database {db_path} does not exist. No migration needed.")
     exit(0)
 
+def get_columns(cursor):
+    cursor.execute("PRAGMA table_info(generated_image)")
+    return [row[1] for row in cursor.fetchall()]
+
 conn = sqlite3.connect(db_path)
 cursor = conn.cursor()
 
 try:
     # Check if column already exists
-    cursor.execute("PRAGMA table_info(generated_image)")
-    columns = [row[1] for row in cursor.fetchall()]
-    
-    if 'original_image_path' in columns:
-        print("Column 'original_image_path' already exists. No migration needed.")
+    if 'original_image_path' in get_columns(cursor):
+        print("Column 'original_image_path' already exists. Skipping.")
     else:
         print("Adding 'original_image_path' column...")
         cursor.execute("ALTER TABLE generated_image ADD COLUMN original_image_path VARCHAR(255)")
         conn.commit()
-        print("Migration completed successfully!")
-        
+
+    # Background generation inserts the row before the breed and images are known, so those
+    # columns become nullable. SQLite can't relax NOT NULL in place, so rebuild the table.
+    if 'status' in get_columns(cursor):
+        print("Column 'status' already exists. Skipping.")
+    else:
+        print("Rebuilding 'generated_image' table with 'status' and 'error_message' columns...")
+        cursor.executescript("""
+            BEGIN;
+            ALTER TABLE generated_image RENAME TO generated_image_old;
+            CREATE TABLE generated_image (
+                id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                original_filename VARCHAR(255) NOT NULL,
+                original_image_path VARCHAR(255),
+                dog_breed VARCHAR(100),
+                image1_path VARCHAR(255),
+                image2_path VARCHAR(255),
+                image3_path VARCHAR(255),
+                status VARCHAR(20) NOT NULL,
+                error_message TEXT,
+                created_at DATETIME,
+                PRIMARY KEY (id),
+                FOREIGN KEY(user_id) REFERENCES user (id)
+            );
+            INSERT INTO generated_image (
+                id, user_id, original_filename, original_image_path, dog_breed,
+                image1_path, image2_path, image3_path, status, created_at
+            )
+            SELECT
+                id, user_id, original_filename, original_image_path, dog_breed,
+                image1_path, image2_path, image3_path, 'done', created_at
+            FROM generated_image_old;
+            DROP TABLE generated_image_old;
+            CREATE INDEX ix_generated_image_user_id ON generated_image (user_id);
+            COMMIT;
+        """)
+
+    columns = get_columns(cursor)
+    for column in ('original_thumb', 'image1_thumb', 'image2_thumb', 'image3_thumb'):
+        if column in columns:
+            print(f"Column '{column}' already exists. Skipping.")
+        else:
+            print(f"Adding '{column}' column...")
+            cursor.execute(f"ALTER TABLE generated_image ADD COLUMN {column} VARCHAR(255)")
+            conn.commit()
+
+    if 'started_at' in columns:
+        print("Column 'started_at' already exists. Skipping.")
+    else:
+        print("Adding 'started_at' column...")
+        cursor.execute("ALTER TABLE generated_image ADD COLUMN started_at DATETIME")
+        conn.commit()
+
+    print("Ensuring index 'ix_generated_image_user_created' exists...")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_generated_image_user_created ON generated_image (user_id, created_at)")
+    conn.commit()
+
+    print("Migration completed successfully!")
+
 except Exception as e:
     print(f"Error during migration: {e}")
     conn.rollback()
 finally:
     conn.close()
-